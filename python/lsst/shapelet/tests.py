@@ -49,12 +49,11 @@ class ShapeletTestCase(lsst.utils.tests.TestCase):
 
     @staticmethod
     def makeImage(function, x, y):
-        z = numpy.zeros((y.size, x.size), dtype=float)
+        gx, gy = numpy.meshgrid(numpy.asarray(x, dtype=float), numpy.asarray(y, dtype=float))
         e = function.evaluate()
-        for i, py in enumerate(y):
-            for j, px in enumerate(x):
-                z[i, j] = e(float(px), float(py))
-        return z
+        # Evaluate all pixels in one call to the vectorized C++ evaluator
+        z = e(gx.ravel(), gy.ravel())
+        return numpy.asarray(z).reshape(gx.shape)
 
     @staticmethod
     def makeRandomShapeletFunction(order=2, zeroCenter=False, ellipse=None, scale=1.0):
@@ -115,6 +114,19 @@ class ShapeletTestCase(lsst.utils.tests.TestCase):
             self.compareShapeletFunctions(sa, sb, rtolEllipse=rtolEllipse, rtolCoeff=rtolCoeff,
                                           atolEllipse=atolEllipse, atolCoeff=atolCoeff)
 
+    def assertImagesAlmostEqual(self, a, b, rtol, relTo):
+        """Check that max(|a - b|) <= rtol*relTo using a single temporary array,
+        deferring to assertFloatsAlmostEqual for diagnostics only on failure.
+        """
+        diff = numpy.subtract(a, b)
+        numpy.abs(diff, out=diff)
+        # diff.max() is NaN if any difference is; written so that NaN or an infinite bound fails.
+        bound = rtol*relTo
+        if not (numpy.isfinite(bound) and diff.max() <= bound):
+            self.assertFloatsAlmostEqual(a, b, rtol=rtol, relTo=relTo,
+                                         printFailures=True, plotOnFailure=False)
+            self.fail("Images differ by more than %g relative to %g, or are not finite" % (rtol, relTo))
+
     def checkMoments(self, function, x, y, z):
         gx, gy = numpy.meshgrid(x, y)
         m = z.sum()
@@ -167,6 +167,14 @@ ShapeletFunctionEvaluator::ShapeletFunctionEvaluator(
 }
 
 ShapeletFunction ShapeletFunction::convolve(ShapeletFunction const & other) const {
+    if (getOrder() == 0 && other.getOrder() == 0) {
+        // Both functions are pure Gaussians (for which the Hermite and Laguerre bases coincide), so
+        // the convolution is analytic: the ellipses convolve and the fluxes multiply.
+        ShapeletFunction result(0, _basisType, _ellipse);
+        result.getEllipse().convolve(other.getEllipse()).inPlace();
+        result.getCoefficients()[0] = FLUX_FACTOR * _coefficients[0] * other.getCoefficients()[0];
+        return result;
+    }
     GaussHermiteConvolution convolution(getOrder(), other);
     afw::geom::ellipses::Ellipse newEllipse(_ellipse);
     ndarray::EigenView<double const,2,2> matrix(convolution.evaluate(newEllipse));
@@ -24,6 +24,7 @@ from future import standard_library
 standard_library.install_aliases()  # noqa E402
 from builtins import zip
 from builtins import range
+import os
 import pickle
 import unittest
 
@@ -35,30 +36,73 @@ import lsst.shapelet.tests
 import lsst.afw.image
 
 
+def makeBasisMatrices():
+    """Return random basis matrices for the testBasis* tests, keyed by shape."""
+    rng = np.random.RandomState(500)
+    return {shape: rng.randn(*shape) for shape in [(3, 2), (6, 2), (1, 2), (3, 3), (6, 3), (1, 3)]}
+
+
+# Generated once at import and shared by the testBasis* tests; MultiShapeletBasis.addComponent
+# deep-copies its matrix argument, so the tests cannot modify these.
+_BASIS_MATS = makeBasisMatrices()
+
+
 class MultiShapeletTestCase(lsst.shapelet.tests.ShapeletTestCase):
 
+    _gaussians_ref = None
+
+    @classmethod
+    def setUpClass(cls):
+        super(MultiShapeletTestCase, cls).setUpClass()
+        np.random.seed(500)
+        # A single random function shared by testMoments and testPickle.  It must not be
+        # modified by any test, or those tests would no longer be independent.
+        cls._random_msf_source = cls.makeRandomMultiShapeletFunction()
+
+        # Unit coefficient vectors for the testBasis* tests, as rows of identity matrices
+        cls._I2 = np.eye(2)
+        cls._I3 = np.eye(3)
+        cls._I5 = np.eye(5)
+
+        # Unit-circle ellipse; tests that modify it must make a copy
+        cls._unit_ellipse = lsst.afw.geom.ellipses.Ellipse(lsst.afw.geom.ellipses.Axes())
+
     def setUp(self):
         np.random.seed(500)
 
+    @classmethod
+    def getGaussiansReference(cls):
+        """Return the GalSim reference image for testConvolveGaussians, reading it on first use."""
+        if cls._gaussians_ref is None:
+            filename = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "gaussians.fits")
+            cls._gaussians_ref = lsst.afw.image.ImageF(filename).getArray().astype(np.float64, copy=True)
+        return cls._gaussians_ref
+
     def testMoments(self):
         x = np.linspace(-50, 50, 1001)
         y = x
-        function = self.makeRandomMultiShapeletFunction()
+        function = self._random_msf_source
         x = np.linspace(-10, 10, 101)
         y = x
         z = self.makeImage(function, x, y)
         self.checkMoments(function, x, y, z)
 
     def testPickle(self):
-        function1 = self.makeRandomMultiShapeletFunction()
-        s = pickle.dumps(function1, protocol=2)
-        function2 = pickle.loads(s)
-        for component1, component2 in zip(function1.getComponents(), function2.getComponents()):
-            self.assertEqual(component1.getOrder(), component2.getOrder())
-            self.assertEqual(component1.getBasisType(), component2.getBasisType())
-            self.assertFloatsAlmostEqual(component1.getEllipse().getParameterVector(),
-                                         component2.getEllipse().getParameterVector())
-            self.assertFloatsAlmostEqual(component1.getCoefficients(), component2.getCoefficients())
+        function1 = self._random_msf_source
+        s = pickle.dumps(function1, protocol=pickle.HIGHEST_PROTOCOL)
+        results = [pickle.loads(s)]
+        if pickle.HIGHEST_PROTOCOL >= 5:
+            # Also check that coefficient arrays survive being passed out-of-band.
+            buffers = []
+            s = pickle.dumps(function1, protocol=pickle.HIGHEST_PROTOCOL, buffer_callback=buffers.append)
+            results.append(pickle.loads(s, buffers=buffers))
+        for function2 in results:
+            for component1, component2 in zip(function1.getComponents(), function2.getComponents()):
+                self.assertEqual(component1.getOrder(), component2.getOrder())
+                self.assertEqual(component1.getBasisType(), component2.getBasisType())
+                self.assertFloatsAlmostEqual(component1.getEllipse().getParameterVector(),
+                                             component2.getEllipse().getParameterVector())
+                self.assertFloatsAlmostEqual(component1.getCoefficients(), component2.getCoefficients())
 
     def testConvolveGaussians(self):
         sigma1 = [lsst.afw.geom.ellipses.Quadrupole(6.0, 5.0, 2.0),
@@ -67,8 +111,6 @@ class MultiShapeletTestCase(lsst.shapelet.tests.ShapeletTestCase):
                   lsst.afw.geom.ellipses.Quadrupole(7.0, 9.0, 1.0)]
         alpha1 = [0.6, 0.4]
         alpha2 = [0.35, 0.65]
-        sigma3 = []
-        alpha3 = []
 
         def makeMultiShapeletFunction(alpha, sigma):
             msf = lsst.shapelet.MultiShapeletFunction()
@@ -78,12 +120,19 @@ class MultiShapeletTestCase(lsst.shapelet.tests.ShapeletTestCase):
                 f.getCoefficients()[0] = a / lsst.shapelet.ShapeletFunction.FLUX_FACTOR
                 msf.addComponent(f)
             return msf
-        for a1, s1 in zip(alpha1, sigma1):
-            for a2, s2 in zip(alpha2, sigma2):
-                sigma3.append(lsst.afw.geom.ellipses.Quadrupole(s1.getIxx() + s2.getIxx(),
-                                                                s1.getIyy() + s2.getIyy(),
-                                                                s1.getIxy() + s2.getIxy()))
-                alpha3.append(a1 * a2)
+
+        def getMoments(sigma):
+            return (np.array([s.getIxx() for s in sigma]),
+                    np.array([s.getIyy() for s in sigma]),
+                    np.array([s.getIxy() for s in sigma]))
+        Ixx1, Iyy1, Ixy1 = getMoments(sigma1)
+        Ixx2, Iyy2, Ixy2 = getMoments(sigma2)
+        alpha3 = np.outer(alpha1, alpha2).ravel()
+        Ixx3 = (Ixx1[:, None] + Ixx2[None, :]).ravel()
+        Iyy3 = (Iyy1[:, None] + Iyy2[None, :]).ravel()
+        Ixy3 = (Ixy1[:, None] + Ixy2[None, :]).ravel()
+        sigma3 = [lsst.afw.geom.ellipses.Quadrupole(float(ixx), float(iyy), float(ixy))
+                  for ixx, iyy, ixy in zip(Ixx3, Iyy3, Ixy3)]
         msf1 = makeMultiShapeletFunction(alpha1, sigma1)
         msf2 = makeMultiShapeletFunction(alpha2, sigma2)
         msf3a = makeMultiShapeletFunction(alpha3, sigma3)
@@ -100,20 +149,39 @@ class MultiShapeletTestCase(lsst.shapelet.tests.ShapeletTestCase):
         self.assertFloatsAlmostEqual(image3a, image3b)
 
         # Now we test against two test images: one implemented right here with numpy calls...
-        xg, yg = np.meshgrid(x, y)
+        # Broadcast row and column vectors instead of materializing a meshgrid.
+        x_r = x[None, :]
+        y_c = y[:, None]
+        x2 = x_r*x_r
+        xy = x_r*y_c
+        y2 = y_c*y_c
 
         def evalMultiGaussian(alpha, sigma):
-            matQ = np.array([[sigma.getIxx(), sigma.getIxy()],
-                             [sigma.getIxy(), sigma.getIyy()]],
-                            dtype=float)
-            invQ = np.linalg.inv(matQ)
-            norm = alpha / np.linalg.det(2.0 * np.pi * matQ)**0.5
-            return norm * np.exp(-0.5 * (invQ[0, 0]*xg**2 + 2.0*invQ[0, 1]*xg*yg + invQ[1, 1]*yg**2))
-        image3c = np.zeros(xg.shape, dtype=float)
-        for a, s in zip(alpha3, sigma3):
-            image3c += evalMultiGaussian(a, s)
-        self.assertFloatsAlmostEqual(image3c, image3a, rtol=1E-6, relTo=np.max(image3c),
-                                     printFailures=True, plotOnFailure=False)
+            """Evaluate a sum of elliptical Gaussians on the grid, all components at once."""
+            a00 = np.empty(len(alpha), dtype=float)
+            a01 = np.empty(len(alpha), dtype=float)
+            a11 = np.empty(len(alpha), dtype=float)
+            norm = np.empty(len(alpha), dtype=float)
+            for n, (a, s) in enumerate(zip(alpha, sigma)):
+                # closed-form inverse and determinant of the 2x2 moments matrix
+                det = s.getIxx()*s.getIyy() - s.getIxy()*s.getIxy()
+                a00[n] = s.getIyy() / det
+                a01[n] = -2.0*s.getIxy() / det
+                a11[n] = s.getIxx() / det
+                norm[n] = a / np.sqrt(4.0*np.pi*np.pi*det)
+            # Axis-aligned components are separable: evaluate 1-d Gaussians along
+            # each axis and combine them with an outer product.
+            aligned = (a01 == 0.0)
+            gx = np.exp(-0.5 * a00[aligned, None]*x*x)
+            gy = np.exp(-0.5 * a11[aligned, None]*y*y)
+            image = np.einsum("n,ni,nj->ij", norm[aligned], gy, gx)
+            general = ~aligned
+            quad = (a00[general, None, None]*x2 + a01[general, None, None]*xy +
+                    a11[general, None, None]*y2)
+            image += (norm[general, None, None] * np.exp(-0.5 * quad)).sum(axis=0)
+            return image
+        image3c = evalMultiGaussian(alpha3, sigma3)
+        self.assertImagesAlmostEqual(image3c, image3a, rtol=1E-6, relTo=np.max(image3c))
 
         # And the second produced by GalSim
         if False:
@@ -129,15 +197,14 @@ class MultiShapeletTestCase(lsst.shapelet.tests.ShapeletTestCase):
                 print("])")
             printForGalSim(alpha1, sigma1)
             printForGalSim(alpha2, sigma2)
-        image3d = lsst.afw.image.ImageF("tests/data/gaussians.fits").getArray().astype(float)
-        self.assertFloatsAlmostEqual(image3d, image3a, rtol=1E-6, relTo=np.max(image3d),
-                                     printFailures=True, plotOnFailure=False)
+        image3d = self.getGaussiansReference()
+        self.assertImagesAlmostEqual(image3d, image3a, rtol=1E-6, relTo=np.max(image3d))
 
     def testBasisNormalize(self):
         def makePositiveMatrix(*shape):
             """Return a random basis matrix, but with a lot of power
             in the zeroth component to ensure the integral is positve."""
-            a = np.random.randn(*shape)
+            a = _BASIS_MATS[shape].copy()
             a[0, :] += 4.0
             return a
         basis = lsst.shapelet.MultiShapeletBasis(2)
@@ -148,39 +215,38 @@ class MultiShapeletTestCase(lsst.shapelet.tests.ShapeletTestCase):
         for n in range(2):
             coefficients = np.zeros(2, dtype=float)
             coefficients[n] = 1.0
-            msf = basis.makeFunction(lsst.afw.geom.ellipses.Ellipse(lsst.afw.geom.ellipses.Axes()),
-                                     coefficients)
+            msf = basis.makeFunction(self._unit_ellipse, coefficients)
             self.assertFloatsAlmostEqual(msf.evaluate().integrate(), 1.0)
 
     def testBasisScale(self):
-        ellipse = lsst.afw.geom.ellipses.Ellipse(lsst.afw.geom.ellipses.Axes())
+        ellipse = lsst.afw.geom.ellipses.Ellipse(self._unit_ellipse)
         basis = lsst.shapelet.MultiShapeletBasis(2)
-        basis.addComponent(0.5, 1, np.random.randn(3, 2))
-        basis.addComponent(1.0, 2, np.random.randn(6, 2))
-        basis.addComponent(1.2, 0, np.random.randn(1, 2))
-        msf1 = [basis.makeFunction(ellipse, self.makeUnitVector(i, 2)) for i in range(2)]
+        basis.addComponent(0.5, 1, _BASIS_MATS[3, 2])
+        basis.addComponent(1.0, 2, _BASIS_MATS[6, 2])
+        basis.addComponent(1.2, 0, _BASIS_MATS[1, 2])
+        msf1 = [basis.makeFunction(ellipse, self._I2[i]) for i in range(2)]
         basis.scale(2.0)
         ellipse.getCore().scale(0.5)
-        msf2 = [basis.makeFunction(ellipse, self.makeUnitVector(i, 2)) for i in range(2)]
+        msf2 = [basis.makeFunction(ellipse, self._I2[i]) for i in range(2)]
         for a, b in zip(msf1, msf2):
             self.compareMultiShapeletFunctions(a, b)
 
     def testBasisMerge(self):
-        ellipse = lsst.afw.geom.ellipses.Ellipse(lsst.afw.geom.ellipses.Axes())
+        ellipse = self._unit_ellipse
         basis1 = lsst.shapelet.MultiShapeletBasis(2)
-        basis1.addComponent(0.5, 1, np.random.randn(3, 2))
-        basis1.addComponent(1.0, 2, np.random.randn(6, 2))
-        basis1.addComponent(1.2, 0, np.random.randn(1, 2))
+        basis1.addComponent(0.5, 1, _BASIS_MATS[3, 2])
+        basis1.addComponent(1.0, 2, _BASIS_MATS[6, 2])
+        basis1.addComponent(1.2, 0, _BASIS_MATS[1, 2])
         basis2 = lsst.shapelet.MultiShapeletBasis(3)
-        basis2.addComponent(0.4, 1, np.random.randn(3, 3))
-        basis2.addComponent(1.1, 2, np.random.randn(6, 3))
-        basis2.addComponent(1.6, 0, np.random.randn(1, 3))
+        basis2.addComponent(0.4, 1, _BASIS_MATS[3, 3])
+        basis2.addComponent(1.1, 2, _BASIS_MATS[6, 3])
+        basis2.addComponent(1.6, 0, _BASIS_MATS[1, 3])
         basis3 = lsst.shapelet.MultiShapeletBasis(basis1)
         basis3.merge(basis2)
         self.assertEqual(basis3.getSize(), 5)
-        msf1 = [basis1.makeFunction(ellipse, self.makeUnitVector(i, 2)) for i in range(2)]
-        msf2 = [basis2.makeFunction(ellipse, self.makeUnitVector(i, 3)) for i in range(3)]
-        msf3 = [basis3.makeFunction(ellipse, self.makeUnitVector(i, 5)) for i in range(5)]
+        msf1 = [basis1.makeFunction(ellipse, self._I2[i]) for i in range(2)]
+        msf2 = [basis2.makeFunction(ellipse, self._I3[i]) for i in range(3)]
+        msf3 = [basis3.makeFunction(ellipse, self._I5[i]) for i in range(5)]
         for a, b in zip(msf3, msf1+msf2):
             self.compareMultiShapeletFunctions(a, b)
 
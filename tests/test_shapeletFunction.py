@@ -147,6 +147,26 @@ class ShapeletFunctionTestCase(lsst.shapelet.tests.ShapeletTestCase):
         fc2.changeBasisType(lsst.shapelet.HERMITE)
         self.assertFloatsAlmostEqual(fc1.getCoefficients(), fc2.getCoefficients(), 1E-8)
 
+    def testConvolveGaussians(self):
+        """Test the analytic convolution of two zeroth-order functions."""
+        if scipy is None:
+            print("Skipping convolution test; scipy could not be imported.")
+            return
+        e1 = ellipses.Ellipse(ellipses.Axes(10, 8, 0.3), geom.Point2D(1.5, 2.0))
+        e2 = ellipses.Ellipse(ellipses.Axes(12, 9, -0.5), geom.Point2D(-1.0, -0.25))
+        f1 = lsst.shapelet.ShapeletFunction(0, lsst.shapelet.HERMITE, e1)
+        f2 = lsst.shapelet.ShapeletFunction(0, lsst.shapelet.LAGUERRE, e2)
+        f1.getCoefficients()[0] = 0.6 / lsst.shapelet.ShapeletFunction.FLUX_FACTOR
+        f2.getCoefficients()[0] = 0.35 / lsst.shapelet.ShapeletFunction.FLUX_FACTOR
+        fc1, fc2 = self.checkConvolution(f1, f2)
+        self.assertEqual(fc1.getOrder(), 0)
+        self.assertEqual(fc1.getBasisType(), lsst.shapelet.HERMITE)
+        self.assertEqual(fc2.getBasisType(), lsst.shapelet.LAGUERRE)
+        self.assertFloatsAlmostEqual(fc1.evaluate().integrate(), 0.6*0.35, rtol=1E-14)
+        self.assertFloatsAlmostEqual(fc1.getEllipse().getParameterVector(),
+                                     fc2.getEllipse().getParameterVector())
+        self.assertFloatsAlmostEqual(fc1.getCoefficients(), fc2.getCoefficients())
+
 
 class MemoryTester(lsst.utils.tests.MemoryTestCase):
     pass